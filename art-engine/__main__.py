@@ -1,4 +1,7 @@
+import logging
+
 import app
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
     app.run()
@@ -1,39 +1,119 @@
-import json
-import random
-
+import io
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+
+import numpy as np
+import orjson
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass
 from pathlib import Path
-from PIL import Image
+from typing import Optional
+from PIL import Image, ImageColor
+from tqdm import tqdm
 
+from utils.composite import composite_batch_gpu, composite_stack, gpu_available, upload_traits
 from utils.parse_yaml import read_yaml
 
 import utils.rich_metadata as rm
 import utils.rarity_rank as rr
 
 
+log = logging.getLogger(__name__)
+
+ASSETS_ROOT = (Path(__file__).parent / 'assets').resolve()
+TRAIT_SUFFIXES = ('.png', '.jpg', '.jpeg')
+
+# Number of tokens composited together when the GPU is used
+GPU_BATCH_SIZE = 16
+
+# Threads writing the metadata files while the images render
+METADATA_WRITERS = 4
+
+# Config, decoded trait pixels and reusable canvas of the current worker process, set up
+# by _init_worker
+_CONFIG = None
+_TRAITS = None
+_CANVAS = None
+
+
+@dataclass(frozen=True)
+class LayerSpec:
+    """A layer's traits and their cumulative rarity weights, resolved once from the config.
+    Specs are never modified, so the config and the weights stay the same for every token.
+    Optional layers hold None in paths at optional_none_index, and bernoulli_race marks
+    layers with near uniform rarities, which are sampled by rejection.
+    """
+    name: str
+    paths: tuple
+    cum_weights: tuple
+    optional_none_index: Optional[int] = None
+    bernoulli_race: bool = False
+
+    @property
+    def weights(self) -> np.ndarray:
+        return np.diff(self.cum_weights, prepend=0)
+
+
+@dataclass(frozen=True)
+class NormalizedConfig:
+    """The validated config values used while creating tokens. It is small and picklable,
+    so it is sent to the worker processes once instead of the whole YAML config. The
+    canvas width, height and bg_color are only set when draw_background is enabled.
+    """
+    layers: list
+    width: Optional[int]
+    height: Optional[int]
+    bg_color: Optional[tuple]
+    token_prefix: str
+    uri_prefix: str
+    description: str
+    draw_background: bool
+    use_gpu: bool
+    png_compress_level: int
+
+
 def make_dirs() -> None:
     """Creates the directories to store creates images and their corresponding json data.
     If the folders already exist, skips and continues.
     """
     print('Creating build directories')
-    build_dirs = ['build', 'build/images', 'build/json']
+    build_dirs = ['build/images', 'build/json']
 
+    # mkdir already handles existing folders, so there is no need to check for them first
     for _dir in build_dirs:
-        _dir = Path(_dir)
-        if not _dir.exists():
-            print(f'Creating {_dir} directory')
-            _dir.mkdir(exist_ok=True)
+        log.debug(f'Creating {_dir} directory')
+        Path(_dir).mkdir(parents=True, exist_ok=True)
 
     print('Build directories created')
 
 
-def join_layers(config_file: object) -> tuple:
-    final_layers = list()
+def _scan_traits(directory: Path) -> list:
+    """Returns the trait image files in a directory, sorted by name. Uses os.scandir
+    so the file type checks come from the cached directory entries.
+    """
+    with os.scandir(directory) as entries:
+        traits = [entry for entry in entries
+                  if entry.is_file() and entry.name.endswith(TRAIT_SUFFIXES)]
+
+    return [Path(entry.path) for entry in sorted(traits, key=lambda entry: entry.name)]
+
+
+def build_layer_index(config_file: object, assets_root: Path = ASSETS_ROOT) -> list:
+    """Scans every layer directory once and returns a LayerSpec for each layer, in config
+    order. Optional layers, rarity mismatches and normalization are all resolved here
+    so nothing needs to be recomputed per token. The config itself is left untouched.
+    """
+    layer_index = list()
 
     for layer in config_file['layers']:
-        layer_path = Path.cwd() / 'art-engine' / 'assets' / layer['name']
-        
-        print(f"Processing layer: {layer['name']}")
-        print(f"Layer path: {layer_path}")
+        layer_path = assets_root / layer['name']
+
+        log.debug(f"Processing layer: {layer['name']}")
+        log.debug(f"Layer path: {layer_path}")
 
         if 'types' in layer:
             # Handle complex layer structure with subfolders
@@ -41,125 +121,379 @@ def join_layers(config_file: object) -> tuple:
             all_rarities = []
             for type_info in layer['types']:
                 for type_name, type_rarities in type_info.items():
-                    type_path = layer_path / type_name
-                    type_layers = sorted([trait for trait in type_path.iterdir() if trait.is_file() and trait.suffix in ['.png', '.jpg', '.jpeg']])
-                    all_layers.extend(type_layers)
+                    all_layers.extend(_scan_traits(layer_path / type_name))
                     all_rarities.extend(type_rarities)
         else:
             # Handle simple layer structure
-            all_layers = sorted([trait for trait in layer_path.iterdir() if trait.is_file() and trait.suffix in ['.png', '.jpg', '.jpeg']])
-            all_rarities = layer['rarities'].copy()
+            all_layers = _scan_traits(layer_path)
+            all_rarities = list(layer['rarities'])
 
-        print(f"Number of items found: {len(all_layers)}")
-        print(f"Rarities: {all_rarities}")
+        log.debug(f"Number of items found: {len(all_layers)}")
+        log.debug(f"Rarities: {all_rarities}")
 
         # Handle optional layers
+        optional_none_index = None
         is_required = layer.get('required', True)
         if not is_required:
-            all_layers.append('None')
+            optional_none_index = len(all_layers)
+            all_layers.append(None)
             none_rarity = 100 - sum(all_rarities)
             all_rarities.append(none_rarity)
-            print(f"Optional layer: {layer['name']}, added 'None' option with rarity {none_rarity}")
+            log.debug(f"Optional layer: {layer['name']}, added 'None' option with rarity {none_rarity}")
 
         # Ensure number of layers matches number of rarities
         if len(all_layers) != len(all_rarities):
-            print(f"Warning: Mismatch in number of items ({len(all_layers)}) and rarities ({len(all_rarities)}) for layer {layer['name']}")
+            log.warning(f"Mismatch in number of items ({len(all_layers)}) and rarities ({len(all_rarities)}) for layer {layer['name']}")
             if len(all_layers) > len(all_rarities):
                 all_rarities.extend([0] * (len(all_layers) - len(all_rarities)))
             else:
                 all_rarities = all_rarities[:len(all_layers)]
-            print(f"Adjusted rarities: {all_rarities}")
+            log.debug(f"Adjusted rarities: {all_rarities}")
 
         # Normalize rarities
         total = sum(all_rarities)
         if total != 100:
-            print(f"Warning: Rarities for layer {layer['name']} sum to {total}. Normalizing...")
+            log.warning(f"Rarities for layer {layer['name']} sum to {total}. Normalizing...")
             all_rarities = [int((r / total) * 100) for r in all_rarities]
             # Ensure the sum is exactly 100 after rounding
             all_rarities[-1] += 100 - sum(all_rarities)
-            print(f"Normalized rarities: {all_rarities}")
+            log.debug(f"Normalized rarities: {all_rarities}")
+
+        # A Bernoulli race needs len * max / total uniform picks per trait on average, so it
+        # is only worth it when the rarities are close to uniform and most picks are kept
+        bernoulli_race = len(all_rarities) * max(all_rarities) <= 2 * sum(all_rarities)
+
+        cum_weights = tuple(itertools.accumulate(all_rarities))
+        layer_index.append(LayerSpec(layer['name'], tuple(all_layers), cum_weights, optional_none_index,
+                                     bernoulli_race))
+
+    return layer_index
+
+
+def normalize_config(config_file: object) -> NormalizedConfig:
+    """Validates the config and resolves every layer once, ahead of generation, so config
+    errors surface before anything is written and the YAML is never read per token.
+    """
+    # The canvas settings are only needed, and only expected in the config, when drawing
+    # a background
+    if config_file['draw_background']:
+        width = config_file['canvas_width']
+        height = config_file['canvas_height']
+        bg_color = ImageColor.getcolor(config_file['background_color'], 'RGBA')
+    else:
+        width = height = bg_color = None
+
+    return NormalizedConfig(
+        layers=build_layer_index(config_file),
+        width=width,
+        height=height,
+        bg_color=bg_color,
+        token_prefix=config_file['token_prefix'],
+        uri_prefix=config_file['uri_prefix'],
+        description=config_file['description'],
+        draw_background=config_file['draw_background'],
+        use_gpu=config_file.get('use_gpu', False),
+        png_compress_level=config_file.get('png_compress_level', 1)
+    )
+
+
+def _bernoulli_race(weights: np.ndarray, size: int, rng: np.random.Generator) -> np.ndarray:
+    """Samples trait indices by picking traits uniformly and keeping each pick with a
+    probability of its weight over the largest weight, redrawing the rejected ones. This
+    needs no cumulative weights or search, only uniform draws.
+    """
+    chosen = np.empty(size, dtype=np.int32)
+    pending = np.arange(size)
+    max_weight = weights.max()
+
+    while len(pending):
+        picks = rng.integers(len(weights), size=len(pending))
+        accepted = rng.random(len(pending)) * max_weight < weights[picks]
+
+        chosen[pending[accepted]] = picks[accepted]
+        pending = pending[~accepted]
+
+    return chosen
+
+
+def sample_dna(layer_index: list, amount: int, rng: np.random.Generator) -> np.ndarray:
+    """Draws the DNA for the whole collection in one go. Each row of the returned matrix
+    is a token, holding the index of the chosen trait for every layer. Extra rows are
+    sampled to absorb duplicates and drawing repeats until enough unique tokens exist.
+    Duplicates are dropped in draw order, so the first unique rows drawn are kept.
+    """
+    combinations = math.prod(np.count_nonzero(spec.weights) for spec in layer_index)
+    if amount > combinations:
+        raise ValueError(f'Only {combinations} unique tokens can be created from the provided layers, '
+                         + f'but {amount} were requested')
+
+    # Packs each row into a single integer, using the layer sizes as a mixed radix, so
+    # duplicates can be found by comparing one int64 per token instead of whole rows
+    sizes = [len(spec.paths) for spec in layer_index]
+    if math.prod(sizes) <= np.iinfo(np.int64).max:
+        radix = np.cumprod([1] + sizes[:-1], dtype=np.int64)
+    else:
+        radix = None
+
+    oversample_amount = int(amount * 1.3)
+    dna = np.empty((0, len(layer_index)), dtype=np.int32)
+
+    while len(dna) < amount:
+        batch = np.empty((oversample_amount, len(layer_index)), dtype=np.int32)
+
+        for i, spec in enumerate(layer_index):
+            if spec.bernoulli_race:
+                batch[:, i] = _bernoulli_race(spec.weights, oversample_amount, rng)
+            else:
+                probs = spec.weights / spec.cum_weights[-1]
+                batch[:, i] = rng.choice(len(spec.paths), size=oversample_amount, p=probs, replace=True)
+
+        dna = np.concatenate((dna, batch))
+
+        if radix is None:
+            _, first_seen = np.unique(dna, axis=0, return_index=True)
+        else:
+            _, first_seen = np.unique(dna @ radix, return_index=True)
+
+        dna = dna[np.sort(first_seen)]
+
+    return dna[:amount]
 
-        chosen_image = random.choices(all_layers, weights=all_rarities)[0]
-        image_path = chosen_image if chosen_image != 'None' else 'None'
 
-        final_layers.append(image_path)
+def join_layers(layer_index: list, dna: np.ndarray) -> tuple:
+    """Maps a token's DNA row back to the chosen trait path of each layer, or None where
+    an optional layer was left out."""
+    return tuple(spec.paths[i] for spec, i in zip(layer_index, dna))
 
-    return tuple(final_layers)
 
+def preload_traits(layer_index: list) -> tuple:
+    """Opens and decodes every trait image once so tokens can be composited without
+    reading or decoding any files again. Returns the pixels of all traits as a single
+    contiguous (N, H, W, 4) uint8 array, along with a lookup array per layer mapping
+    each trait index to its position in that array, or -1 for the None option. Traits
+    smaller than the largest one are padded with transparency from the top left corner.
+    """
+    trait_ids = dict()
+    trait_lookup = list()
+
+    for spec in layer_index:
+        lookup = [trait_ids.setdefault(trait, len(trait_ids)) if i != spec.optional_none_index else -1
+                  for i, trait in enumerate(spec.paths)]
+        trait_lookup.append(np.array(lookup, dtype=np.int32))
+
+    # Opening an image only reads its header, so the sizes are cheap to find up front
+    sizes = list()
+    for path in trait_ids:
+        with Image.open(path) as image:
+            sizes.append(image.size)
+
+    width = max((size[0] for size in sizes), default=0)
+    height = max((size[1] for size in sizes), default=0)
+    traits = np.zeros((len(trait_ids), height, width, 4), dtype=np.uint8)
+
+    for path, trait_id in trait_ids.items():
+        # Only the decoded pixels are kept, so the file is closed as soon as they are read.
+        # Most trait PNGs are already RGBA, which would make convert a needless copy.
+        with Image.open(path) as image:
+            pixels = np.asarray(image if image.mode == 'RGBA' else image.convert('RGBA'))
+
+        traits[trait_id, :pixels.shape[0], :pixels.shape[1]] = pixels
 
-def create_metadata(config_file: object, edition: int, final_layers: tuple) -> None:
-    token_prefix = config_file['token_prefix']
-    token_description = config_file['description']
-    uri_prefix = config_file['uri_prefix']
+    return traits, trait_lookup
 
+
+def _init_worker(config: NormalizedConfig, traits: np.ndarray) -> None:
+    global _CONFIG, _TRAITS, _CANVAS
+    _CONFIG = config
+    _TRAITS = traits
+    _CANVAS = np.empty(canvas_shape(config, traits), dtype=np.uint8)
+
+
+def create_metadata(config: NormalizedConfig, edition: int, dna: np.ndarray) -> None:
     metadata_dict = {
-        'name': f'{token_prefix} #{edition}',
-        'description': token_description,
-        'image': f'{uri_prefix}baseURI/{edition}.png',
+        'name': f'{config.token_prefix} #{edition}',
+        'description': config.description,
+        'image': f'{config.uri_prefix}baseURI/{edition}.png',
         'edition': edition,
         'attributes': []
     }
 
-    for layer, config_layer in zip(final_layers, config_file['layers']):
-        if layer != 'None':
+    for spec, layer in zip(config.layers, join_layers(config.layers, dna)):
+        if layer is not None:
             attributes_dict = {
-                'trait_type': config_layer['name'],
+                'trait_type': spec.name,
                 'value': layer.parent.name,
                 'sub_value': layer.stem
             }
             metadata_dict['attributes'].append(attributes_dict)
 
-    with open(f'build/json/{edition}.json', 'w', encoding='utf-8') as outfile:
-        json.dump(metadata_dict, outfile, indent=2)
+    write_file(f'build/json/{edition}.json', orjson.dumps(metadata_dict, option=orjson.OPT_INDENT_2))
 
 
-def create_image(config_file: object, edition: int, final_layers: tuple) -> None:
-    if config_file['draw_background']:
-        width = config_file['canvas_width']
-        height = config_file['canvas_height']
-        bg_color = config_file['background_color']
-        base_image = Image.new(mode='RGBA', size=(width, height), color=bg_color)
+def canvas_shape(config: NormalizedConfig, traits: np.ndarray) -> tuple:
+    if config.draw_background:
+        return (config.height, config.width, 4)
+
+    # The first layer is composited onto a transparent canvas to act as the background
+    return traits.shape[1:]
+
+
+def create_image(config: NormalizedConfig, edition: int, trait_ids: np.ndarray, traits: np.ndarray,
+                 base_image: np.ndarray) -> None:
+    """Composites a token onto base_image, a canvas reused between tokens, and saves it.
+    The canvas is reset to the background color rather than allocating a new one.
+    """
+    if config.draw_background:
+        base_image[:] = config.bg_color
     else:
-        base_image = Image.open(final_layers[0]).convert('RGBA')
-        final_layers = final_layers[1:]
+        base_image.fill(0)
+
+    # Like alpha_composite, traits are placed at the top left corner of the canvas
+    composite_stack(base_image[:traits.shape[1], :traits.shape[2]], traits, trait_ids)
+
+    save_image(config, edition, base_image)
+
+
+def save_image(config: NormalizedConfig, edition: int, image: np.ndarray) -> None:
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG', compress_level=config.png_compress_level, optimize=False)
+
+    write_file(f'build/images/{edition}.png', buffer.getbuffer())
+
 
-    for file in final_layers:
-        if file != 'None':
-            img = Image.open(file).convert('RGBA')
-            base_image.alpha_composite(img)
+def write_file(path: str, data: bytes) -> None:
+    """Writes an already encoded file in one unbuffered write, instead of the many small
+    writes made when encoding straight into the file.
+    """
+    with open(path, 'wb', buffering=0) as outfile:
+        view = memoryview(data)
+        # A raw write may be partial, so keep going until everything is written
+        while view:
+            view = view[outfile.write(view):]
+
+
+def render_token(edition: int, trait_ids: np.ndarray) -> None:
+    """Creates the image of a single token. Runs inside a worker process."""
+    create_image(_CONFIG, edition, trait_ids, _TRAITS, _CANVAS)
+
+
+def render_tokens(config: NormalizedConfig, editions: range, dna: np.ndarray, token_trait_ids: np.ndarray,
+                  traits: np.ndarray) -> None:
+    """Streams the tokens through two pools so the disk writes overlap the compositing.
+    The metadata is written by a small thread pool, while the images are composited and
+    encoded across worker processes. At most two renders per core are in flight at once,
+    which keeps every worker busy without queueing the whole collection up front.
+    Workers are spawned rather than forked, as the metadata threads and the executor's
+    own management thread are already running when new workers start.
+    """
+    max_in_flight = 2 * os.cpu_count()
+
+    with tqdm(total=len(editions), desc='Creating tokens', unit='token') as progress, \
+            ThreadPoolExecutor(max_workers=METADATA_WRITERS) as writer, \
+            ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker, initargs=(config, traits)) as renderer:
+        written = list()
+        rendering = set()
+
+        for edition, row, trait_ids in zip(editions, dna, token_trait_ids):
+            written.append(writer.submit(create_metadata, config, edition, row))
+
+            if len(rendering) >= max_in_flight:
+                done, rendering = wait(rendering, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update()
+
+            rendering.add(renderer.submit(render_token, edition, trait_ids))
+
+        for future in as_completed(rendering):
+            future.result()
+            progress.update()
+
+        # Surfaces any errors raised while writing the metadata
+        for future in written:
+            future.result()
+
+
+def render_tokens_gpu(config: NormalizedConfig, editions: range, dna: np.ndarray, token_trait_ids: np.ndarray,
+                      traits: np.ndarray) -> None:
+    """Composites the tokens in batches on the GPU. The metadata and finished PNGs are
+    written on a thread pool while the next batch is being composited. The GPU is much
+    faster than the PNG encoder, so once two saves per core are pending the next batch
+    waits for some of them, rather than piling up uncompressed images in memory.
+    """
+    traits_gpu = upload_traits(traits)
+    background = config.bg_color if config.draw_background else None
+    max_in_flight = 2 * os.cpu_count()
 
-    base_image.save(f'build/images/{edition}.png')
+    with tqdm(total=len(editions), desc='Creating tokens', unit='token') as progress, \
+            ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        written = list()
+        saving = set()
+
+        for start in range(0, len(editions), GPU_BATCH_SIZE):
+            batch_editions = editions[start:start + GPU_BATCH_SIZE]
+
+            for edition, row in zip(batch_editions, dna[start:start + GPU_BATCH_SIZE]):
+                written.append(executor.submit(create_metadata, config, edition, row))
+
+            while len(saving) >= max_in_flight:
+                done, saving = wait(saving, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update()
+
+            images = composite_batch_gpu(traits_gpu, token_trait_ids[start:start + GPU_BATCH_SIZE], background)
+            saving.update(executor.submit(save_image, config, edition, image)
+                          for edition, image in zip(batch_editions, images))
+
+        for future in as_completed(saving):
+            future.result()
+            progress.update()
+
+        # Surfaces any errors raised while writing the metadata
+        for future in written:
+            future.result()
 
 
 def run() -> None:
-    """ Main collection creation function. Creates a build directory, 
-    edition counter, then loops through for the desired amount. DNA set keeps track 
-    of each created image to avoid duplicates being created."""
+    """ Main collection creation function. Validates the config and samples the unique
+    DNA for every token up front, creates a build directory, then creates the metadata
+    and image of every token across a pool of worker processes, or in batches on the
+    GPU if enabled."""
 
     config_file = read_yaml()
-    dna_set = set()
+    config = normalize_config(config_file)
 
     if config_file['id_from_one']:
         edition = 1
-        desired_amount = config_file['amount'] + 1
     else:
         edition = 0
-        desired_amount = config_file['amount']
+
+    rng = np.random.default_rng(config_file.get('seed'))
+    dna = sample_dna(config.layers, config_file['amount'], rng)
+
+    traits, trait_lookup = preload_traits(config.layers)
 
     make_dirs()
 
-    while edition < desired_amount:
-        print(f'Creating token #{edition}')
+    editions = range(edition, edition + len(dna))
+    token_trait_ids = np.column_stack([lookup[dna[:, i]] for i, lookup in enumerate(trait_lookup)])
 
-        token_layers = join_layers(config_file)
+    use_gpu = config.use_gpu
+    if use_gpu and not gpu_available():
+        log.warning('No CUDA device available, compositing on the CPU instead')
+        use_gpu = False
+    elif use_gpu and config.draw_background and traits.shape[1:3] != (config.height, config.width):
+        log.warning('Traits do not match the canvas size, compositing on the CPU instead')
+        use_gpu = False
 
-        if token_layers not in dna_set:
-            create_metadata(config_file, edition, token_layers)
-            create_image(config_file, edition, token_layers)
-            dna_set.add(token_layers)
-            edition += 1
-        else:
-            print(f'Token #{edition} already exists, re-creating token')
+    if use_gpu:
+        render_tokens_gpu(config, editions, dna, token_trait_ids, traits)
+    else:
+        render_tokens(config, editions, dna, token_trait_ids, traits)
+
+    edition += len(dna)
 
     amount = config_file['amount']
 
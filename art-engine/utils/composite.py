@@ -0,0 +1,104 @@
+""" Alpha compositing kernels used to layer the traits of each token """
+
+import numpy as np
+
+from numba import njit
+
+
+@njit(cache=True)
+def composite_stack(base: np.ndarray, traits: np.ndarray, trait_ids: np.ndarray) -> None:
+    """ Composites the chosen traits over the base image in place. traits holds every
+    decoded trait as an (N, H, W, 4) uint8 array, and trait_ids the index into it for
+    each layer in order, where -1 skips the layer. Each row of the base is blended with
+    every layer's matching row while it is still in cache, and the blend uses the same
+    integer arithmetic as Pillow's alpha_composite, so the output is identical to it.
+    """
+    height, width = base.shape[0], base.shape[1]
+
+    for y in range(height):
+        for trait_id in trait_ids:
+            if trait_id < 0:
+                continue
+
+            row = traits[trait_id, y]
+            for x in range(width):
+                fg_alpha = np.int64(row[x, 3])
+
+                # Fully transparent and fully opaque pixels are by far the most common
+                if fg_alpha == 0:
+                    continue
+                if fg_alpha == 255:
+                    base[y, x, 0] = row[x, 0]
+                    base[y, x, 1] = row[x, 1]
+                    base[y, x, 2] = row[x, 2]
+                    base[y, x, 3] = 255
+                    continue
+
+                # Pillow's "over" operator, in 7 bit fixed point with a rounded divide by 255
+                blend = np.int64(base[y, x, 3]) * (255 - fg_alpha)
+                out_alpha_255 = fg_alpha * 255 + blend
+                fg_coef = fg_alpha * 255 * 255 * 128 // out_alpha_255
+                bg_coef = 255 * 128 - fg_coef
+
+                for channel in range(3):
+                    value = np.int64(row[x, channel]) * fg_coef + np.int64(base[y, x, channel]) * bg_coef
+                    value += 0x80 << 7
+                    base[y, x, channel] = ((((value >> 8) + value) >> 8) >> 7)
+
+                out_alpha = out_alpha_255 + 0x80
+                base[y, x, 3] = ((out_alpha >> 8) + out_alpha) >> 8
+
+
+def gpu_available() -> bool:
+    """ Checks whether PyTorch is installed and can see a CUDA device. PyTorch is only
+    needed when compositing on the GPU, so it is imported lazily.
+    """
+    try:
+        import torch
+    except ImportError:
+        return False
+
+    return torch.cuda.is_available()
+
+
+def upload_traits(traits: np.ndarray):
+    """ Copies the decoded traits onto the GPU once, as float16 values between 0 and 1.
+    A fully transparent trait is appended at the end, so the -1 id of a 'None' option
+    indexes into it like any other trait.
+    """
+    import torch
+
+    traits_gpu = torch.zeros((len(traits) + 1, *traits.shape[1:]), dtype=torch.float16, device='cuda')
+    traits_gpu[:-1] = torch.from_numpy(traits).to('cuda')
+    traits_gpu[:-1] /= 255
+
+    return traits_gpu
+
+
+def composite_batch_gpu(traits_gpu, trait_ids: np.ndarray, background: tuple = None) -> np.ndarray:
+    """ Composites a batch of tokens at once on the GPU. trait_ids is a (B, layers) array
+    of indices into the uploaded traits, and background the RGBA color of the canvas,
+    or None for a transparent one. Returns the images as a (B, H, W, 4) uint8 array.
+    """
+    import torch
+
+    ids = torch.from_numpy(trait_ids).to('cuda', dtype=torch.long)
+    size = (len(trait_ids), *traits_gpu.shape[1:3])
+
+    rgb = torch.zeros((*size, 3), dtype=torch.float16, device='cuda')
+    alpha = torch.zeros((*size, 1), dtype=torch.float16, device='cuda')
+    if background is not None:
+        rgb[:] = torch.tensor(background[:3], dtype=torch.float16, device='cuda') / 255
+        alpha[:] = background[3] / 255
+
+    for layer in range(ids.shape[1]):
+        fg = traits_gpu[ids[:, layer]]
+        fg_alpha = fg[..., 3:]
+
+        # Same "over" operator as composite_stack, broadcast over the whole batch
+        bg_weight = alpha * (1 - fg_alpha)
+        out_alpha = fg_alpha + bg_weight
+        rgb = (fg[..., :3] * fg_alpha + rgb * bg_weight) / out_alpha.clamp(min=1e-3)
+        alpha = out_alpha
+
+    return torch.cat((rgb, alpha), dim=-1).mul_(255).round_().to(torch.uint8).cpu().numpy()